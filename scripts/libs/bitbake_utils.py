@@ -119,7 +119,7 @@ def setup_bitbake_env(proot, logfile):
     if not conf_generated:
         plnx_utils.CopyDir(
             plnx_vars.EsdkConfDir.format(proot),
-            plnx_vars.ConfDir.format(proot)
+            plnx_vars.ConfDir.format(proot), plain_files=True
         )
         plnx_utils.RemoveFile(plnx_vars.DevtoolConfFile.format(proot))
         plnx_utils.remove_str_from_file(
@@ -193,7 +193,7 @@ def get_yocto_source(proot):
             'Extracting yocto SDK to components/yocto. This may take time!')
         sdk_command += '%s -p -y -d "%s"' % (yocto_esdkpath,
                                              plnx_vars.EsdkInstalledDir.format(proot))
-        plnx_utils.runCmd(sdk_command, proot, shell=True)
+        plnx_utils.runCmd(sdk_command, proot, shell=True, stream=True)
 
         plnx_utils.remove_str_from_file(
             plnx_vars.LockedSigsFile.format(
@@ -8,6 +8,7 @@
 #
 # SPDX-License-Identifier: MIT
 
+import functools
 import logging
 import os
 import re
@@ -17,6 +18,24 @@ import sys
 
 logger = logging.getLogger('PetaLinux')
 
+# Parsed config files keyed by filename:
+#   filename -> ((st_mtime_ns, st_size), lines, {macro: value})
+_CONFIG_CACHE = {}
+
+_GCC_VER_RE = re.compile(r'(\d+)\.(\d+)\.\d+')
+
+
+@functools.lru_cache(maxsize=256)
+def _compile(pattern, flags=0):
+    '''Compile the pattern once and reuse it across calls'''
+    return re.compile(pattern, flags)
+
+
+def _macro_line_re(macro):
+    '''Pattern matching every line which sets or unsets macro'''
+    return _compile(r'^.*(?:# %s is not set|%s=).*(?:\n|$)' % (
+        re.escape(macro), re.escape(macro)), re.M)
+
 
 def CreateDir(dirpath):
     '''Creates Directory'''
@@ -59,17 +78,112 @@ def RemoveFile(filepath):
         os.remove(filepath)
 
 
-def CopyDir(indir, outdir, exclude=''):
+# ioctl(2) request to share the extents of a file (reflink)
+FICLONE = 0x40049409
+# (src st_dev, dst st_dev) pairs on which FICLONE is not supported
+_NO_REFLINK_DEVS = set()
+
+
+def _fast_copy(src, dst):
+    '''Copy file with a reflink clone if the filesystem supports it
+    and fall back to shutil.copy2 otherwise'''
+    import errno
+    import fcntl
+    devs = (os.stat(src).st_dev, os.stat(os.path.dirname(dst)).st_dev)
+    if devs not in _NO_REFLINK_DEVS:
+        with open(src, 'rb') as src_f, open(dst, 'wb') as dst_f:
+            try:
+                fcntl.ioctl(dst_f.fileno(), FICLONE, src_f.fileno())
+                cloned = True
+            except OSError as e:
+                if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY,
+                                   errno.EXDEV, errno.EINVAL):
+                    raise
+                _NO_REFLINK_DEVS.add(devs)
+                cloned = False
+        if cloned:
+            shutil.copystat(src, dst)
+            return dst
+    return shutil.copy2(src, dst)
+
+
+def _remove_dst(dst, keep_dir=False):
+    '''Remove what is at dst, like tar -x does before extracting a member
+    Symlinks are removed and never followed, directories only if empty'''
+    if os.path.islink(dst):
+        os.remove(dst)
+    elif os.path.isdir(dst):
+        if not keep_dir:
+            os.rmdir(dst)
+    elif os.path.lexists(dst):
+        os.remove(dst)
+
+
+def _copy_tree(indir, outdir, exclude=''):
+    '''Recursively copy indir into outdir the way tar -x would,
+    keeping symlinks and replacing the files which already exist
+    Only directories, symlinks and regular files are supported'''
+    import fnmatch
+    CreateDir(outdir)
+    with os.scandir(indir) as entries:
+        for entry in entries:
+            if exclude and fnmatch.fnmatch(entry.name, exclude):
+                continue
+            dst = os.path.join(outdir, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                _remove_dst(dst, keep_dir=True)
+                _copy_tree(entry.path, dst, exclude)
+                continue
+            if not entry.is_symlink() and not entry.is_file(follow_symlinks=False):
+                raise Exception('Unable to copy %s, not a regular file' % entry.path)
+            _remove_dst(dst)
+            if entry.is_symlink():
+                os.symlink(os.readlink(entry.path), dst)
+            else:
+                _fast_copy(entry.path, dst)
+    shutil.copystat(indir, outdir)
+
+
+def CopyDir(indir, outdir, exclude='', plain_files=False):
     '''Copy Directory to Directory
-    Using tar command to copy dirs which is twice
-    faster than shutil.copytree and support exclude option'''
+    Using tar command to copy dirs which keeps sparse files, hard links,
+    special files and xattrs and support exclude option.
+    plain_files - the tree has only directories, symlinks and regular
+    files, copy it in process cloning the files where the filesystem
+    supports reflinks, exclude is a file name pattern'''
     if os.path.exists(indir):
         if not os.path.exists(outdir):
             CreateDir(outdir)
-        copycmd = "tar --xattrs --xattrs-include='*' --exclude='%s' \
-                -cf - -S -C %s -p . | tar --xattrs --xattrs-include='*' \
-                -xf - -C %s" % (exclude, indir, outdir)
-        runCmd(copycmd, os.getcwd(), shell=True)
+        if plain_files:
+            _copy_tree(indir, outdir, exclude)
+            return
+        tar_opts = ['--xattrs', '--xattrs-include=*']
+        create_cmd = ['tar'] + tar_opts + ['--exclude=%s' % exclude,
+                                           '-cf', '-', '-S', '-C', indir, '-p', '.']
+        extract_cmd = ['tar'] + tar_opts + ['-xf', '-', '-C', outdir]
+        logger.debug('%s | %s' % (create_cmd, extract_cmd))
+        import tempfile
+        # stderr goes to files, a full stderr pipe of tar -c would stall
+        # the whole pipeline while tar -x waits for its input
+        with tempfile.TemporaryFile() as create_err, \
+                tempfile.TemporaryFile() as extract_err:
+            create_p = subprocess.Popen(create_cmd, stdout=subprocess.PIPE,
+                                        stderr=create_err)
+            extract_p = subprocess.Popen(extract_cmd, stdin=create_p.stdout,
+                                         stderr=extract_err)
+            # Let tar -c see SIGPIPE if tar -x exits early
+            create_p.stdout.close()
+            extract_p.wait()
+            create_p.wait()
+            create_err.seek(0)
+            extract_err.seek(0)
+            stderr = create_err.read().decode('utf-8', 'replace') + \
+                extract_err.read().decode('utf-8', 'replace')
+        if create_p.returncode != 0 or extract_p.returncode != 0:
+            raise Exception('\n%s\nFailed to copy %s to %s' %
+                            (stderr, indir, outdir))
+        if stderr:
+            logger.debug(stderr)
 
 
 def CopyFile(infile, dest, follow_symlinks=False):
@@ -110,15 +224,22 @@ def GetFileType(filepath):
 
 
 def IsElfFile(filepath):
-    stdout = GetFileType(filepath)
-    if bool(re.search('ELF', stdout)):
-        return True
-    return False
+    '''Check the ELF magic of the file instead of running file(1)
+    Symlinks are not followed, same as file(1) reported them'''
+    if not filepath or os.path.islink(filepath) or \
+            not os.path.isfile(filepath) or os.path.getsize(filepath) < 4:
+        return False
+    with open(filepath, 'rb') as f:
+        return f.read(4) == b'\x7fELF'
 
 
 def runCmd(command, out_dir, extraenv=None,
-           failed_msg='', shell=False, checkcall=False):
-    '''Run Shell commands from python'''
+           failed_msg='', shell=False, checkcall=False, stream=False):
+    '''Run Shell commands from python
+    stream - log the output line by line instead of returning it and
+             keep only the last lines for the error message, use it
+             rather than discarding the output so failures can report
+             what the command printed'''
     command = command.split() if not shell else command
     logger.debug(command)
     env = os.environ.copy()
@@ -129,6 +250,24 @@ def runCmd(command, out_dir, extraenv=None,
         subprocess.check_call(
             command, env=extraenv, cwd=out_dir, shell=shell)
         return
+    elif stream:
+        import collections
+        tail = collections.deque(maxlen=200)
+        process = subprocess.Popen(command,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT,
+                                   env=env, shell=shell,
+                                   executable='/bin/bash',
+                                   cwd=out_dir, bufsize=1,
+                                   universal_newlines=True,
+                                   errors='replace')
+        with process.stdout:
+            for line in process.stdout:
+                logger.debug(line.rstrip('\n'))
+                tail.append(line)
+        if process.wait() != 0:
+            raise Exception('\n%s\n%s' % (''.join(tail), failed_msg))
+        return
     else:
         process = subprocess.Popen(command,
                                    stdout=subprocess.PIPE,
@@ -150,73 +289,127 @@ def runCmd(command, out_dir, extraenv=None,
         return stdout, stderr
 
 
+# Directories which replace_multi_fromdir does not descend into
+_REPLACE_SKIP_DIRS = frozenset(('.git', '.svn', '.hg'))
+# Binary files whose contents replace_multi_fromdir does not read
+_REPLACE_SKIP_EXTS = frozenset(('.o', '.ko', '.so', '.a', '.elf', '.img',
+                                '.bin', '.bit', '.pdi', '.xsa', '.gz',
+                                '.xz', '.bz2', '.zip', '.tar'))
+
+
+def replace_multi_fromdir(dirpath, pairs, include_dir_names=False):
+    '''Replace the strings with strings in the files and directory names
+    Same as replace_str_fromdir for a list of (search_str, replace_str)
+    pairs, walking the dirpath only once. All the pairs are replaced in
+    a single pass, the longest search_str wins where several match
+    '''
+    replace_map = dict((search_str, replace_str)
+                       for search_str, replace_str in pairs if search_str)
+    if not replace_map:
+        return
+    searches = sorted(replace_map, key=len, reverse=True)
+    str_re = re.compile('|'.join(re.escape(search) for search in searches))
+    bytes_map = dict((search.encode('utf-8'), replace.encode('utf-8'))
+                     for search, replace in replace_map.items())
+    bytes_re = re.compile(b'|'.join(re.escape(search.encode('utf-8'))
+                                    for search in searches))
+    for dname, dirs, files in os.walk(dirpath, topdown=True):
+        dirs[:] = [d for d in dirs if d not in _REPLACE_SKIP_DIRS]
+        for fname in files:
+            fpath = os.path.join(dname, fname)
+            new_fpath = fpath
+            if include_dir_names:
+                new_fpath = os.path.join(dname, str_re.sub(
+                    lambda m: replace_map[m.group(0)], fname))
+            data = new_data = None
+            if os.path.splitext(fname)[1] not in _REPLACE_SKIP_EXTS:
+                with open(fpath, 'rb') as f:
+                    data = f.read()
+                if bytes_re.search(data):
+                    try:
+                        # Only rewrite the text files
+                        data.decode('utf-8')
+                        new_data = bytes_re.sub(
+                            lambda m: bytes_map[m.group(0)], data)
+                    except UnicodeDecodeError:
+                        pass
+            if new_data is not None and new_data != data:
+                # Rewrite in place so the file keeps its mode
+                with open(fpath, 'wb') as f:
+                    f.write(new_data)
+            if new_fpath != fpath:
+                os.rename(fpath, new_fpath)
+
+
 def replace_str_fromdir(dirpath, search_str, replace_str, include_dir_names=False):
     '''Replace the string with string in the files and directory names
     Gets the all files from dirpath and search for the given search_str
     replace with replace_str if found in file and filenames
+    Files which does not have search_str are neither decoded nor rewritten
     '''
-    for dname, dirs, files in os.walk(dirpath):
-        for fname in files:
-            fpath = os.path.join(dname, fname)
-            try:
-                with open(fpath) as f:
-                    s = f.read()
-                    s = s.replace(search_str, replace_str)
-            except UnicodeDecodeError:
-                pass
-            if include_dir_names:
-                fname = fname.replace(search_str, replace_str)
-                RemoveFile(fpath)
-                fpath = os.path.join(dname, fname)
-            with open(fpath, 'w') as f:
-                f.write(s)
+    replace_multi_fromdir(dirpath, [(search_str, replace_str)],
+                          include_dir_names)
 
 
 def remove_str_from_file(filename, string):
-    '''Remove the line that matches with string'''
-    lines = []
+    '''Remove the line that matches with string
+    string can be a regex pattern or an already compiled one'''
+    pattern = _compile(string) if isinstance(string, str) else string
     if os.path.exists(filename):
         with open(filename, 'r') as file_data:
             lines = file_data.readlines()
         with open(filename, 'w') as file_data:
-            for line in lines:
-                if re.search(string, line):
-                    continue
-                file_data.write(line)
+            file_data.write(''.join(
+                line for line in lines if not pattern.search(line)))
 
 
 def add_str_to_file(filename, string, ignore_if_exists=False, mode='w'):
-    '''Add string or line into the given file and ignore if already exists in file'''
-    lines = []
-    string_found = False
-    if os.path.exists(filename):
-        with open(filename, 'r') as file_data:
-            lines = file_data.readlines()
-    for line in lines:
-        if re.match(string, line):
-            string_found = True
-    if not ignore_if_exists or not string_found:
-        with open(filename, mode) as file_f:
-            file_f.write(string)
+    '''Add string or line into the given file and ignore if already exists in file
+    string exists if any line of the file starts with it'''
+    if ignore_if_exists:
+        text = ''.join(_read_config_file(filename)[0])
+        if text.startswith(string) or ('\n' + string) in text:
+            return
+    clear_config_cache(filename)
+    with open(filename, mode) as file_f:
+        file_f.write(string)
 
 
 def concate_files(fromfile, tofile):
-    '''Merge files into one'''
-    with open(tofile, 'a') as tofile_f:
-        with open(fromfile, 'r') as fromfile_f:
-            tofile_f.write(fromfile_f.read())
+    '''Merge files into one
+    The data is copied in kernel with sendfile where supported'''
+    # sendfile(2) fails with EINVAL on O_APPEND fds, seek to the end instead
+    tofile_fd = os.open(tofile, os.O_WRONLY | os.O_CREAT, 0o666)
+    with open(tofile_fd, 'wb') as tofile_f:
+        tofile_f.seek(0, os.SEEK_END)
+        with open(fromfile, 'rb') as fromfile_f:
+            size = os.fstat(fromfile_f.fileno()).st_size
+            offset = 0
+            try:
+                while offset < size:
+                    sent = os.sendfile(tofile_f.fileno(), fromfile_f.fileno(),
+                                       offset, size - offset)
+                    if not sent:
+                        break
+                    offset += sent
+            except OSError:
+                # No sendfile for these files, copy the rest in user space
+                fromfile_f.seek(offset)
+                tofile_f.seek(0, os.SEEK_END)
+                shutil.copyfileobj(fromfile_f, tofile_f, 1024 * 1024)
 
 
 def get_filehashvalue(filename):
     '''Get sha256 for given file'''
     import hashlib
-    import mmap
-    method = hashlib.sha256()
     with open(filename, "rb") as f:
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+        import mmap
+        method = hashlib.sha256()
         try:
             with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
-                for chunk in iter(lambda: mm.read(8192), b''):
-                    method.update(chunk)
+                method.update(mm)
         except ValueError:
             # You can't mmap() an empty file so silence this exception
             pass
@@ -224,56 +417,86 @@ def get_filehashvalue(filename):
 
 
 def get_free_port(port=9000):
-    '''Get the free port to use'''
-    import socket, random
+    '''Get the free port to use
+    port is preferred if free, otherwise the kernel picks one'''
+    import socket
     from contextlib import closing
-    while True:
-        with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as sock:
-            if sock.connect_ex(('localhost', port)) == 0:
-                # Port is open, so not free
-                # Generate random int and try again
-                port = port + random.randint(0, 9)
-                continue
-            else:
-                # Port is not open, so free
-                # return port
-                return port
+    with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind(('localhost', port))
+        except OSError:
+            # Port is in use, let the kernel assign a free one
+            sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
 
 
 def update_config_value(macro, value, filename):
     '''Update the value for macro in a given filename'''
-    lines = []
+    clear_config_cache(filename)
+    text = ''
     if os.path.exists(filename):
         with open(filename, 'r') as file_data:
-            lines = file_data.readlines()
-        file_data.close()
-
+            text = _macro_line_re(macro).sub('', file_data.read())
+        if text and not text.endswith('\n'):
+            text += '\n'
+    if value == 'disable':
+        text += '# %s is not set\n' % macro
+    else:
+        text += '%s=%s\n' % (macro, value)
     with open(filename, 'w') as file_data:
-        for line in lines:
-            if re.search('# %s is not set' % macro, line) or re.search('%s=' % macro, line):
-                continue
-            file_data.write(line)
-        if value == 'disable':
-            file_data.write('# %s is not set\n' % macro)
-        else:
-            file_data.write('%s=%s\n' % (macro, value))
-    file_data.close()
+        file_data.write(text)
+
+
+def clear_config_cache(filename=None):
+    '''Drop the cached contents of filename or of all config files'''
+    if filename:
+        _CONFIG_CACHE.pop(filename, None)
+    else:
+        _CONFIG_CACHE.clear()
+
+
+def _read_config_file(filename):
+    '''Return the lines and macro values of filename, re-reading only
+    if the file has changed since the last call'''
+    try:
+        st = os.stat(filename)
+    except OSError:
+        _CONFIG_CACHE.pop(filename, None)
+        return [], {}
+    stamp = (st.st_mtime_ns, st.st_size)
+    cached = _CONFIG_CACHE.get(filename)
+    if cached and cached[0] == stamp:
+        return cached[1], cached[2]
+    with open(filename, 'r') as file_data:
+        lines = file_data.readlines()
+    values = {}
+    for line in lines:
+        line = line.strip()
+        if '=' in line:
+            macro = line.split('=', 1)[0]
+            if macro not in values:
+                values[macro] = line.replace(
+                    macro + '=', '').replace('"', '')
+    _CONFIG_CACHE[filename] = (stamp, lines, values)
+    return lines, values
+
+
+def parse_config_file(filename):
+    '''Parse all the macro=value lines of filename in one go
+    Returns a read-only {macro: value} mapping with the same values
+    get_config_value gives for the bool type, it is the cached map
+    itself so it costs no copy per call'''
+    import types
+    return types.MappingProxyType(_read_config_file(filename)[1])
 
 
 def get_config_value(macro, filename, Type='bool', end_macro='=y'):
     '''Get the macro value from given filename'''
-    lines = []
-    if os.path.exists(filename):
-        with open(filename, 'r') as file_data:
-            lines = file_data.readlines()
-        file_data.close()
+    lines, values = _read_config_file(filename)
     value = ''
     if Type == 'bool':
-        for line in lines:
-            line = line.strip()
-            if line.startswith(macro + '='):
-                value = line.replace(macro + '=', '').replace('"', '')
-                break
+        value = values.get(macro, '')
     elif Type == 'choice':
         for line in lines:
             line = line.strip()
@@ -286,9 +509,10 @@ def get_config_value(macro, filename, Type='bool', end_macro='=y'):
             if line.startswith(macro) and line.endswith(end_macro):
                 value += ' ' + line.replace(macro, '').replace(end_macro, '')
     elif Type == 'asterisk':
+        pattern = _compile(end_macro)
         for line in lines:
             line = line.strip()
-            if line.startswith(macro) and re.search(end_macro, line):
+            if line.startswith(macro) and pattern.search(line):
                 value = line.split('=')[1].replace('"', '')
                 break
     return value
@@ -296,18 +520,39 @@ def get_config_value(macro, filename, Type='bool', end_macro='=y'):
 
 def check_gcc_version():
     ''' Check GCC version of the Host machine v/s required version'''
-    gcc_cmd = 'gcc --version | sed -ne "s/.* \([0-9]\+\.[0-9]\+\)\.[0-9]\+.*/\\1/p"'
-    cur_version = runCmd(gcc_cmd, os.getcwd(), shell=True)
     required_version = 7
-    if float(cur_version[0].strip()) <= required_version:
+    cur_version = None
+    try:
+        gcc_out = subprocess.check_output(['gcc', '--version'],
+                                          universal_newlines=True)
+        # Last x.y.z of the first line, same as the old sed expression
+        versions = _GCC_VER_RE.findall(gcc_out.splitlines()[0])
+        if versions:
+            cur_version = tuple(int(v) for v in versions[-1])
+    except (OSError, IndexError, subprocess.CalledProcessError):
+        pass
+    if not cur_version or cur_version <= (required_version, 0):
         logger.error('Seems like Host machine does not have gcc %s or greater version.'
                      % required_version)
         sys.exit(255)
-    return cur_version
+    return '%d.%d' % cur_version
 
 
 def get_filesystem_id(path):
-    '''Run stat command and get the filesystem ID'''
+    '''Get the filesystem type magic in hex, same as stat -f -c %t
+    statfs(2) is called through ctypes, stat command is the fallback'''
+    import ctypes
+    try:
+        statfs = ctypes.CDLL(None, use_errno=True).statfs
+    except (AttributeError, OSError):
+        statfs = None
+    if statfs:
+        # f_type is the first member of struct statfs, buffer is
+        # big enough for the whole struct on all the architectures
+        buf = ctypes.create_string_buffer(256)
+        if statfs(os.fsencode(path), buf) != 0:
+            return None
+        return '%x' % ctypes.c_ulong.from_buffer(buf).value
     try:
         return subprocess.check_output(["stat", "-f", "-c", "%t", path]).decode('utf-8').strip()
     except subprocess.CalledProcessError:
@@ -316,10 +561,29 @@ def get_filesystem_id(path):
 
 def check_tool(tools=[], failed_msg=''):
     '''Check the tools exists in PATH variable or not and give error if not found'''
-    for tool in tools.split():
-        tool = tool.lower()
-        tool_path = shutil.which(tool)
-        if not tool_path:
+    tools = [tool.lower() for tool in tools.split()]
+    available = set()
+    wanted = set(tool for tool in tools if not os.path.dirname(tool))
+    if len(wanted) > 1:
+        # Scan each PATH directory once for all the tools instead of
+        # probing every directory per tool as shutil.which does
+        scanned = set()
+        for path_dir in os.environ.get('PATH', os.defpath).split(os.pathsep):
+            path_dir = path_dir or os.curdir
+            if path_dir in scanned:
+                continue
+            scanned.add(path_dir)
+            try:
+                with os.scandir(path_dir) as entries:
+                    for entry in entries:
+                        if entry.name in wanted and entry.is_file() and \
+                                os.access(entry.path, os.X_OK):
+                            available.add(entry.name)
+            except OSError:
+                continue
+    for tool in tools:
+        # Single tools and tools given with a path use shutil.which
+        if tool not in available and not shutil.which(tool):
             logger.error(
                 'This tool requires "%s" and it is missing. %s' % (tool, failed_msg))
             sys.exit(255)
@@ -349,21 +613,18 @@ def GetFileSize(FilePath):
         return FileInfo.st_size
 
 def HighestPowerof2(FilePath):
-    FileSize=GetFileSize(FilePath)
-    if isinstance(FileSize, float):
-        Size_=int(FileSize) + 1
-    else:
-        Size_=FileSize
-
-    if not Size_ & (Size_ - 1) == 0 and Size_ > 0:
-        import math
-        p = int(math.log(Size_, 2)) + 1
-        return int(pow(2, p))
-    else:
-        return Size_
+    '''Return the file size rounded up to the next power of 2'''
+    Size_ = GetFileSize(FilePath)
+    if Size_ > 0:
+        return 1 << (Size_ - 1).bit_length()
+    return Size_
 
 def MakePowerof2(Image):
+    '''Grow the image to the next power of 2 size
+    Same as qemu-img resize -f raw, which only extends a raw file'''
     Power2Size = HighestPowerof2(Image)
-    QemuImgCmd = 'qemu-img resize -f raw %s %s' % (Image, Power2Size)
-    stdout = runCmd(QemuImgCmd, os.getcwd(),
-                               failed_msg='Fail to launch qemu img cmd', shell=True, checkcall=True)
+    try:
+        os.truncate(Image, Power2Size)
+    except OSError as e:
+        logger.error('Fail to resize %s to %s: %s' % (Image, Power2Size, e))
+        sys.exit(255)
@@ -96,7 +96,7 @@ def SetupAppsModules(args, template_path, cpath, proot):
     proot - Project Directory
     Update recipe file with user specified SRC_URI and STATIC_PN
     '''
-    plnx_utils.CopyDir(template_path, cpath)
+    plnx_utils.CopyDir(template_path, cpath, plain_files=True)
     recipe_name = args.name
     config_string = 'CONFIG_%s\n' % (args.name)
     plnx_utils.add_str_to_file(
@@ -106,12 +106,14 @@ def SetupAppsModules(args, template_path, cpath, proot):
         map_str = '@appname@'
     else:
         map_str = '@modname@ @mod_name@'
+    map_pairs = []
     for _str in map_str.split():
         r_name = recipe_name
         if _str == '@mod_name@':
             r_name = recipe_name.replace('-', '_').replace('+', '_')
-        plnx_utils.replace_str_fromdir(
-            cpath, _str, r_name, include_dir_names=True)
+        map_pairs.append((_str, r_name))
+    plnx_utils.replace_multi_fromdir(
+        cpath, map_pairs, include_dir_names=True)
 
     srcuri2add = []
     if args.network_srcuris:
@@ -214,8 +216,8 @@ def Createproject(args, proot, cpath):
                 args.source, project, tar_extraargs)
             msgonfail = 'Failed to extract %s from BSP %s!' % (
                 project, args.source)
-            cmd_status = plnx_utils.runCmd(
-                tar_cmd, cpath, failed_msg=msgonfail, shell=True)
+            plnx_utils.runCmd(
+                tar_cmd, cpath, failed_msg=msgonfail, shell=True, stream=True)
             create_tmpdir_ifnfs(proot, project, args.tmpdir)
             installed_proj.append(project)
 
@@ -232,10 +234,11 @@ def Createproject(args, proot, cpath):
             sys.exit(255)
         plnx_utils.CreateDir(cpath)
         plnx_utils.CopyDir(
-            plnx_vars.TemplateCommon.format(args.command), cpath)
+            plnx_vars.TemplateCommon.format(args.command), cpath,
+            plain_files=True)
         plnx_utils.CopyDir(plnx_vars.TemplateDir_C.format(
             args.command, args.template),
-            cpath)
+            cpath, plain_files=True)
         # Update the host name and the produdct name of the project
         project_name = os.path.basename(cpath)
         plnx_utils.replace_str_fromdir(cpath, '@projname@', project_name)
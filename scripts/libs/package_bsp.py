@@ -182,7 +182,7 @@ def PackageBsp(args, proot):
     plnx_utils.CreateDir(os.path.dirname(PackageName))
     tar_cmd = 'tar -C "%s" -cf - %s | xz -9 -T%s > %s' % (
         TmpBspDir, ProjBaseNames, args.threads, PackageName)
-    plnx_utils.runCmd(tar_cmd, out_dir=os.getcwd(), shell=True)
+    plnx_utils.runCmd(tar_cmd, out_dir=os.getcwd(), shell=True, stream=True)
 
 
 def pkgbsp_args(bsp_parser):
@@ -20,6 +20,8 @@ from common_utils import *
 
 logger = logging.getLogger('PetaLinux')
 
+_WS_RE = re.compile(r'\s')
+
 
 def is_hwflow_sdt(proot):
     '''Determine if the project configured with SDT or XSA'''
@@ -32,54 +34,56 @@ def is_hwflow_sdt(proot):
 
 def get_plnx_projects_from_bsp(source):
     '''Get the Projects from BSP tar ball'''
-    contents_cmd = 'tar --exclude="*/*/*" -tf "%s"' % (source)
-    contents, stderr = runCmd(contents_cmd, os.getcwd(), shell=True)
+    import tarfile
     projects = []
-    for content in contents.split():
-        project_name = content.split('/')[0]
-        projects.append(project_name) if project_name not in projects else ''
+    has_metadata = set()
+    # Stream the members, the same as 'tar --exclude="*/*/*" -tf'
+    # only the top two levels are of interest
+    with tarfile.open(source, mode='r|*') as tar_f:
+        for member in tar_f:
+            # TarFile keeps every member it reads, drop them as we go
+            tar_f.members = []
+            names = member.name.split('/')
+            if len(names) > 2 and names[2]:
+                continue
+            project_name = names[0]
+            if project_name not in projects:
+                projects.append(project_name)
+            if len(names) > 1 and \
+                    '/'.join(names[:2]) == plnx_vars.MetaDataDir.format(project_name):
+                has_metadata.add(project_name)
+
+    real_proj = [p for p in projects if p in has_metadata]
+    return real_proj
 
-    real_proj = []
-    for p in projects:
-        if plnx_vars.MetaDataDir.format(p) in contents:
-            real_proj.append(p)
 
-    return real_proj
+def _check_proot(proot):
+    '''Exit if the project directory includes any whitespace'''
+    if _WS_RE.search(proot):
+        logger.error('Your project directory %s includes space.'
+                     'PetaLinux project directory should not include space.' % (proot))
+        sys.exit(255)
+    return proot
 
 
 def exit_not_plnx_project(proot):
     '''Check the proot is valide or not by checking .petalinux directory'''
-    workingdir = os.getcwd()
-    parentdir = ''
-    if proot:
-        proot = os.path.realpath(proot)
-    else:
-        while True:
-            if os.path.exists(plnx_vars.MetaDataDir.format(workingdir)):
-                proot = workingdir
-                if bool(re.search(r"\s", proot)):
-                    logger.error('Your project directory %s includes space.'
-                                 'PetaLinux project directory should not include space.' % (proot))
-                    sys.exit(255)
-                return proot
-            parentdir = os.path.dirname(workingdir)
-            if parentdir == workingdir:
-                break
-            workingdir = parentdir
+    if not proot:
+        import pathlib
+        workingdir = pathlib.Path(os.getcwd())
+        for parentdir in (workingdir,) + tuple(workingdir.parents):
+            if parentdir.joinpath(plnx_vars.MetaDataDirName).exists():
+                return _check_proot(str(parentdir))
         logger.error(
             'You are not inside a PetaLinux project. Please specify a PetaLinux project!')
         sys.exit(255)
 
+    proot = os.path.realpath(proot)
     if not os.path.exists(plnx_vars.MetaDataDir.format(proot)):
         logger.error('"%s" is not a valid PetaLinux project.'
                      'Please create a project with petalinux-create -t project first!' % (proot))
         sys.exit(255)
-
-    if bool(re.search(r"\s", proot)):
-        logger.error('Your project directory %s includes space.'
-                     'PetaLinux project directory should not include space.' % (proot))
-        sys.exit(255)
-    return proot
+    return _check_proot(proot)
 
 
 def petalinux_version_check(proot):
@@ -276,8 +280,12 @@ def config_initscripts(proot):
         add_str_to_file(plnx_vars.P_Interfaces.format(proot),
                         plnx_vars.ActInterfaceStr.format(
             ip_addr, ip_netmask, ip_gateway))
-        cidr_netmask = sum(bin(int(x)).count('1')
-                           for x in ip_netmask.split('.'))
+        import socket
+        packed_netmask = int.from_bytes(socket.inet_aton(ip_netmask), 'big')
+        if hasattr(packed_netmask, 'bit_count'):
+            cidr_netmask = packed_netmask.bit_count()
+        else:
+            cidr_netmask = bin(packed_netmask).count('1')
         add_str_to_file(plnx_vars.P_SystemdWired.format(proot),
                         plnx_vars.ActWiredStr.format(
             ip_addr, cidr_netmask, ip_gateway))
@@ -285,27 +293,21 @@ def config_initscripts(proot):
         CreateDir(plnx_vars.P_BusyBoxDir.format(proot))
         CopyFile(plnx_vars.T_InetDFile.format(proot),
                  plnx_vars.P_InetDConf.format(proot))
-        replace_str_fromdir(plnx_vars.P_BusyBoxDir.format(proot),
-                            '#telnet', 'telnet')
-        replace_str_fromdir(plnx_vars.P_BusyBoxDir.format(proot),
-                            '#ftp', 'ftp')
-        replace_str_fromdir(plnx_vars.P_BusyBoxDir.format(proot),
-                            '-w /var/ftp/', '-w')
+        replace_multi_fromdir(plnx_vars.P_BusyBoxDir.format(proot),
+                              [('#telnet', 'telnet'), ('#ftp', 'ftp'),
+                               ('-w /var/ftp/', '-w')])
 
 
 def gen_sysconf_dtsi_file(proot):
     '''Generate sysconf.dtsi file for SDT flow'''
-    dts_dir = get_config_value(
-        'CONFIG_SUBSYSTEM_DT_XSCT_WORKSPACE',
-        plnx_vars.SysConfFile.format(proot))
+    sysconf = parse_config_file(plnx_vars.SysConfFile.format(proot))
+    dts_dir = sysconf.get('CONFIG_SUBSYSTEM_DT_XSCT_WORKSPACE', '')
     dts_dir = dts_dir.replace('${PROOT}', proot)
     dts_dir = dts_dir.replace('$PROOT', proot)
     SdtSystemConfDtsi = os.path.join(dts_dir, 'system-conf.dtsi')
-    bootargs = get_config_value(plnx_vars.AutoBootArgsConf,
-                                plnx_vars.SysConfFile.format(proot))
+    bootargs = sysconf.get(plnx_vars.AutoBootArgsConf, '')
     if not bootargs:
-        bootargs = get_config_value(plnx_vars.BootArgsCmdLineConf,
-                                    plnx_vars.SysConfFile.format(proot))
+        bootargs = sysconf.get(plnx_vars.BootArgsCmdLineConf, '')
     add_str_to_file(SdtSystemConfDtsi,
                     plnx_vars.SystemconfBootargs.format(bootargs))
     eth_ipname = get_config_value(
@@ -318,32 +320,25 @@ def gen_sysconf_dtsi_file(proot):
         add_str_to_file(SdtSystemConfDtsi,
                         plnx_vars.SystemconfEth.format(
                             eth_ipname, eth_mac), mode='a')
-    flash_ipname = get_config_value(plnx_vars.FlashIpConf,
-                                    plnx_vars.SysConfFile.format(proot))
+    flash_ipname = sysconf.get(plnx_vars.FlashIpConf, '')
     if flash_ipname:
-        prev_part_offset = '0x0'
-        prev_part_size = '0x0'
+        part_offset = 0
         add_str_to_file(SdtSystemConfDtsi,
                         plnx_vars.SystemconfFlash.format(
                             flash_ipname), mode='a')
         for num in range(0, 19):
-            part_offset = add_offsets(prev_part_offset, prev_part_size)
-            part_name = get_config_value('%s%s%s%s' % (
-                plnx_vars.FlashConfs['Prefix'], '%s_PART' % flash_ipname.upper(),
-                num, plnx_vars.FlashConfs['Name']),
-                plnx_vars.SysConfFile.format(proot))
-            part_size = get_config_value('%s%s%s%s' % (
-                plnx_vars.FlashConfs['Prefix'], '%s_PART' % flash_ipname.upper(),
-                num, plnx_vars.FlashConfs['Size']),
-                plnx_vars.SysConfFile.format(proot))
-            prev_part_offset = part_offset
-            prev_part_size = part_size
-            if part_name:
-                add_str_to_file(SdtSystemConfDtsi,
-                                plnx_vars.FlashPartNode.format(
-                                    num, part_name, part_offset, part_size), mode='a')
-            else:
+            part_prefix = '%s%s%s' % (plnx_vars.FlashConfs['Prefix'],
+                                      '%s_PART' % flash_ipname.upper(), num)
+            part_name = sysconf.get(
+                part_prefix + plnx_vars.FlashConfs['Name'], '')
+            part_size = sysconf.get(
+                part_prefix + plnx_vars.FlashConfs['Size'], '')
+            if not part_name:
                 break
+            add_str_to_file(SdtSystemConfDtsi,
+                            plnx_vars.FlashPartNode.format(
+                                num, part_name, hex(part_offset), part_size), mode='a')
+            part_offset += int(part_size, base=16)
         add_str_to_file(SdtSystemConfDtsi,
                         plnx_vars.FlashendSymbols, mode='a')
 
@@ -394,6 +389,8 @@ def setup_plnwrapper(args, proot, config_target, gen_confargs):
     xilinx_arch = get_xilinx_arch(proot)
     bitbake_utils.run_genmachineconf(
         proot, xilinx_arch, gen_confargs, add_layers, args.logfile)
+    # gen-machineconf rewrites the project configs behind our back
+    clear_config_cache()
     if add_layers:
         workspace_path = get_workspace_path(proot)
         logger.info('Generating workspace directory')
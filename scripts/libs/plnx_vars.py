@@ -32,7 +32,8 @@ EsdkInstalledDir = os.path.join(ProotSub, 'components', 'yocto')
 PlnxWorkspace = os.path.join(ProotSub, 'components', 'plnx_workspace')
 GitIgnoreFile = os.path.join(ProotSub, '.gitignore')
 ProjectSpec = os.path.join(ProotSub, 'project-spec')
-MetaDataDir = os.path.join(ProotSub, '.petalinux')
+MetaDataDirName = '.petalinux'
+MetaDataDir = os.path.join(ProotSub, MetaDataDirName)
 MetaDataFile = os.path.join(MetaDataDir, 'metadata')
 SysConfDir = os.path.join(ProjectSpec, 'configs')
 SysConfFile = os.path.join(SysConfDir, 'config')